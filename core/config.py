@@ -4,5 +4,17 @@ def get_settings() -> Dict:
     """Return default settings for the app."""
     return {
         "host": "127.0.0.1",
-        "port": 8000
+        "port": 8000,
+        # Opt-in downscale of large JPEGs (None = keep full resolution). A JPEG whose longest side exceeds this is
+        # decoded at the smallest 1/2, 1/4 or 1/8 scale still at least this big, and the output has that size
+        # (e.g. 4096 turns a 10000 px photo into 5000 px and leaves a 6000 px one as it is)
+        "max_side": None,
+        # Pillow resampling filter for the map thumbnail ("nearest", "bilinear", "bicubic", "lanczos", ...)
+        "resize_filter": "bilinear",
+        # Where image processing runs: "thread" (default) or "process" for a pool of worker processes
+        "executor": "thread",
+        # Number of worker processes when executor is "process" (None = one per CPU)
+        "process_workers": None,
+        # SQLite file for persistent address/weather lookups (None = cache/lookups.sqlite3 in the project)
+        "cache_db": None
     }
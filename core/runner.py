@@ -1,21 +1,79 @@
+import asyncio
+import functools
+import mimetypes
+import multiprocessing
+from pathlib import PurePath
+from urllib.parse import quote
+from concurrent.futures import ProcessPoolExecutor
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
-from .utils import embed_metadata
+from PIL import Image
+from .utils import _LOOKUPS, LOOKUP_TIMEOUT, embed_metadata_bytes, get_address, get_weather, image_fits_overlay, imaging_backend, output_format_for
 from .config import get_settings
-from starlette.background import BackgroundTask
+
+
+def _task_result(task, done, default):
+    """Result of a finished lookup task, or default if it is still running or failed."""
+    if task in done and task.exception() is None:
+        return task.result()
+    return default
+
+
+async def _fetch_context(latitude: float, longitude: float, timeout: float = LOOKUP_TIMEOUT):
+    """
+    Look up address and weather concurrently. Returns (address, weather_icon_path, temp_str).
+    Waits at most timeout seconds for both together; a lookup that isn't done by then gets its fallback value.
+    The lookups run on the lookup pool, not the default thread pool: an abandoned lookup keeps its thread
+    until it gives up, and must not hold up run_cpu for this or later requests.
+    """
+    address_task = asyncio.wrap_future(_LOOKUPS.submit(get_address, latitude, longitude))
+    weather_task = asyncio.wrap_future(_LOOKUPS.submit(get_weather, latitude, longitude))
+    done, _ = await asyncio.wait((address_task, weather_task), timeout=timeout)
+    address = _task_result(address_task, done, "Unknown Location")
+    icon_path, temp_str = _task_result(weather_task, done, (None, "N/A"))
+    return address, icon_path, temp_str
+
+
+def _download_name(filename: str, image_format: str) -> str:
+    """filename, with its extension replaced if it doesn't match the format the image was written in."""
+    if output_format_for(filename) == image_format:
+        return filename
+    extension = mimetypes.guess_extension(Image.MIME.get(image_format, "")) or f".{image_format.lower()}"
+    return str(PurePath(filename).with_suffix(extension)) if PurePath(filename).suffix else filename + extension
+
+
+def _attachment_headers(filename: str) -> dict:
+    """Content-Disposition header offering the result as a download under the original filename."""
+    quoted = quote(filename)
+    if quoted != filename:
+        return {"Content-Disposition": f"attachment; filename*=utf-8''{quoted}"}
+    return {"Content-Disposition": f'attachment; filename="{filename}"'}
+
 
 class Runner:
     """Main application runner for the backend API."""
     def __init__(self, config: dict):
         self.config = config
+        # Optional process pool for the CPU-heavy image work; otherwise it runs on the default thread pool
+        self.process_pool = None
+        if config.get("executor") == "process":
+            # Spawn, don't fork: a forked child would inherit core.utils' thread pools without their threads
+            # (and a copy of the multi-threaded server), so work handed to those pools would never run
+            self.process_pool = ProcessPoolExecutor(max_workers=config.get("process_workers"), mp_context=multiprocessing.get_context("spawn"))
         self.app = FastAPI(title="Fake GeoTag API")
         self.setup_routes()
         self.app.mount("/web", StaticFiles(directory="web"), name="web")
 
+    async def run_cpu(self, func, *args):
+        """Run a blocking function off the event loop, in the process pool if one is configured."""
+        if self.process_pool is not None:
+            return await asyncio.get_running_loop().run_in_executor(self.process_pool, func, *args)
+        return await run_in_threadpool(func, *args)
+
     def setup_routes(self):
         from fastapi import UploadFile, File, Form
-        from fastapi.responses import FileResponse, JSONResponse
-        import os, uuid
+        from fastapi.responses import JSONResponse, Response
 
         @self.app.post("/api/fake-metadata")
         async def fake_metadata(
@@ -25,44 +83,35 @@ class Runner:
             date: str = Form(...),
             time: str = Form(...),
             map_image: UploadFile = File(None),
+            overlay: bool = Form(True),
         ):
-            """Endpoint to receive image and metadata, embed EXIF, and return new image. Accepts optional map screenshot."""
-            import os
-            import uuid
-            gen_dir = os.path.join(os.path.dirname(__file__), '..', 'generated')
-            os.makedirs(gen_dir, exist_ok=True)
-            temp_input = os.path.join(gen_dir, f"temp_{uuid.uuid4().hex}_{file.filename}")
-            temp_output = os.path.join(gen_dir, f"output_{uuid.uuid4().hex}_{file.filename}")
-            temp_map = None
-            with open(temp_input, "wb") as f:
-                f.write(await file.read())
-            map_img_bytes = None
-            if map_image is not None:
-                temp_map = os.path.join(gen_dir, f"temp_{uuid.uuid4().hex}_map.png")
-                with open(temp_map, "wb") as mf:
-                    mf.write(await map_image.read())
-                map_img_bytes = temp_map
+            """Endpoint to receive image and metadata, embed EXIF, and return new image. Accepts optional map screenshot.
+            Send overlay=false to only write the EXIF tags and leave the pixels untouched."""
+            # Images stay in memory end to end: upload bytes -> PIL -> response body
+            input_bytes = await file.read()
+            map_bytes = await map_image.read() if map_image is not None else None
             try:
-                embed_metadata(temp_input, temp_output, latitude, longitude, date, time, map_img_bytes)
-                # Use BackgroundTask to delete output after response is sent
-                def cleanup():
-                    for f in [temp_output]:
-                        if f and os.path.exists(f):
-                            try:
-                                os.remove(f)
-                            except Exception:
-                                pass
-                return FileResponse(temp_output, filename=file.filename, background=BackgroundTask(cleanup))
+                # Images too small for the overlay only get EXIF tags, so don't look anything up for them
+                overlay = overlay and image_fits_overlay(input_bytes)
+                context = await _fetch_context(latitude, longitude) if overlay else None
+                # Encode to the format the upload's extension names (as a save to that filename would), else keep the input's
+                filename = file.filename or "image"
+                embed = functools.partial(
+                    embed_metadata_bytes, input_bytes, latitude, longitude, date, time,
+                    map_image=map_bytes, precomputed=context, overlay=overlay,
+                    max_side=self.config.get("max_side"), output_format=output_format_for(filename),
+                )
+                out_bytes, out_format = await self.run_cpu(embed)
+                media_type = Image.MIME.get(out_format, "application/octet-stream")
+                return Response(content=out_bytes, media_type=media_type, headers=_attachment_headers(_download_name(filename, out_format)))
             except Exception as e:
                 return JSONResponse({"error": str(e)}, status_code=500)
-            finally:
-                for f in [temp_input, temp_map]:
-                    if f and os.path.exists(f):
-                        try:
-                            os.remove(f)
-                        except Exception:
-                            pass
 
     def start(self):
         import uvicorn
-        uvicorn.run(self.app, host=self.config.get("host", "127.0.0.1"), port=self.config.get("port", 8000))
+        print(f"[INFO] Imaging backend: {imaging_backend()}")
+        try:
+            uvicorn.run(self.app, host=self.config.get("host", "127.0.0.1"), port=self.config.get("port", 8000))
+        finally:
+            if self.process_pool is not None:
+                self.process_pool.shutdown()
@@ -1,10 +1,32 @@
+import PIL
 from PIL import Image, ImageDraw, ImageFont
 from datetime import datetime
-from typing import Optional
+from typing import NamedTuple, Optional, Tuple
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import logging
+import json
+import sqlite3
+import time as _time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import piexif
 from pathlib import Path
+from .config import get_settings
+import io
 
+try:
+    # Optional faster JSON decoder; the stdlib json module does the same job without it
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+
+log = logging.getLogger(__name__)
 
 # Directory for weather icons (should be in web/static or similar)
 WEATHER_ICON_DIR = Path(__file__).parent.parent / "web" / "weather_icons"
@@ -13,94 +35,449 @@ WEATHER_ICON_MAP = {
 }
 
 
-def get_address(latitude: float, longitude: float) -> str:
-    """Reverse geocode lat/lon to a detailed address using Nominatim."""
+def imaging_backend() -> str:
+    """Describe the PIL build in use. Pillow-SIMD releases carry a ".postN" version suffix."""
+    name = "Pillow-SIMD" if ".post" in PIL.__version__ else "Pillow"
+    return f"{name} {PIL.__version__}"
+
+
+# Small shared pool for CPU work that can overlap with image processing (EXIF serialization)
+_WORKERS = ThreadPoolExecutor(max_workers=8, thread_name_prefix="geotag")
+# Separate pool for the network lookups: an abandoned lookup can keep retrying for a while,
+# and must not hold up EXIF serialization for other requests
+_LOOKUPS = ThreadPoolExecutor(max_workers=8, thread_name_prefix="geotag-lookup")
+# Longest the overlay waits for the address and weather lookups (together) before drawing the fallback text
+LOOKUP_TIMEOUT = 6
+
+# Shared HTTP session so connections (and TLS) to Nominatim/Open-Meteo are kept alive between requests.
+# pool_connections is the number of hosts to keep pools for; pool_maxsize the idle connections kept per host.
+# Only failed connects are retried (once): a server that accepts but never answers costs one read timeout.
+_HTTP = requests.Session()
+_HTTP.headers["User-Agent"] = "FakeGeoTag/1.0"
+_HTTP.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=Retry(total=1, read=0, backoff_factor=0.2)))
+# (connect, read) timeout in seconds used for every outbound request. Worst case for one lookup is a failed
+# connect plus a slow connect and read (1.5 + 1.5 + 2 = 5 s), which has to stay below LOOKUP_TIMEOUT so a
+# stale cache entry can still stand in before the overlay gives up waiting.
+_HTTP_TIMEOUT = (1.5, 2)
+
+# How long cached lookups stay valid (seconds)
+ADDRESS_TTL = 30 * 24 * 60 * 60
+WEATHER_TTL = 10 * 60
+# How old an expired entry may be and still stand in when its refresh fails (None: no limit).
+# Addresses hardly change; an hour-old temperature is the most we pass off as current.
+WEATHER_MAX_STALE = 6 * WEATHER_TTL
+# After a failed refresh the stale entry is kept in memory this long, so an outage isn't paid for on every request
+STALE_RETRY_TTL = 60
+# Lookups also persist across restarts in this SQLite file (see the "cache_db" setting)
+CACHE_DB = Path(__file__).parent.parent / "cache" / "lookups.sqlite3"
+
+
+class _TTLCache:
+    """Small thread-safe LRU cache whose entries expire `ttl` seconds after being stored."""
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < _time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: Optional[float] = None) -> None:
+        """Store value for ttl seconds (default: the cache's ttl)."""
+        with self._lock:
+            self._data[key] = (value, _time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class _DiskCache:
+    """
+    Persistent JSON-value cache in a single SQLite table, opened on first use.
+    Rows keep the HTTP validators (ETag/Last-Modified) of the response they came from,
+    so expired entries can be revalidated with a conditional request.
+    Any SQLite or filesystem error (e.g. read-only disk), or a row that can't be decoded, is treated as a cache miss.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS geocache (key TEXT PRIMARY KEY, value TEXT NOT NULL, ts REAL NOT NULL, validators TEXT)")
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str):
+        """Return (value, age_seconds, validators) for key, or None if it was never stored."""
+        try:
+            with self._lock:
+                row = self._connect().execute("SELECT value, ts, validators FROM geocache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            return _json_loads(row[0]), _time.time() - row[1], _json_loads(row[2]) if row[2] else None
+        except (sqlite3.Error, OSError, ValueError):
+            return None
+
+    def set(self, key: str, value, validators: Optional[dict] = None) -> None:
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute(
+                    "INSERT OR REPLACE INTO geocache (key, value, ts, validators) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value), _time.time(), json.dumps(validators) if validators else None),
+                )
+                conn.commit()
+        except (sqlite3.Error, OSError):
+            pass
+
+
+_ADDRESS_CACHE = _TTLCache(ADDRESS_TTL)
+_WEATHER_CACHE = _TTLCache(WEATHER_TTL)
+_DISK_CACHE = _DiskCache(get_settings().get("cache_db") or CACHE_DB)
+
+# Returned by fetchers when a conditional request came back 304 Not Modified
+_NOT_MODIFIED = object()
+
+
+def _coord_key(latitude: float, longitude: float):
+    """Quantize coordinates to 4 decimals (~11 m) so nearby lookups share a cache entry."""
+    return (round(latitude, 4), round(longitude, 4))
+
+
+def _cached_lookup(kind: str, memory: _TTLCache, fetch, latitude: float, longitude: float, max_stale: Optional[float] = None):
+    """
+    Look up (latitude, longitude) in memory, then on disk, then via fetch(lat, lon, validators).
+    An expired disk entry is revalidated with its stored validators, and is served as-is if the
+    refresh fails and it is at most max_stale seconds old. Only successful fetches are persisted; a stale entry
+    served after a failed refresh is kept in memory for STALE_RETRY_TTL before the next refresh attempt.
+    Returns None if every step failed.
+    """
+    key = _coord_key(latitude, longitude)
+    value = memory.get(key)
+    if value is not None:
+        return value
+    disk_key = f"{kind}:{key[0]},{key[1]}"
+    entry = _DISK_CACHE.get(disk_key)
+    stale, validators = None, None
+    if entry is not None:
+        stale, age, validators = entry
+        if age < memory.ttl:
+            memory.set(key, stale, memory.ttl - age)
+            return stale
+    value, new_validators = fetch(*key, validators)
+    if value is _NOT_MODIFIED:
+        value = stale
+    if value is None:
+        if entry is None or (max_stale is not None and age > max_stale):
+            return None
+        memory.set(key, stale, STALE_RETRY_TTL)
+        return stale
+    memory.set(key, value)
+    _DISK_CACHE.set(disk_key, value, new_validators)
+    return value
+
+
+def _get_json(url: str, validators: Optional[dict] = None):
+    """
+    GET url on the shared session and decode the JSON body. validators are conditional headers
+    saved from an earlier response. Returns (data, validators): data is _NOT_MODIFIED on a 304
+    and None on failure.
+    """
     try:
-        url = f"https://nominatim.openstreetmap.org/reverse?format=jsonv2&lat={latitude}&lon={longitude}&zoom=16&addressdetails=1"
-        headers = {"User-Agent": "FakeGeoTag/1.0"}
-        resp = requests.get(url, headers=headers, timeout=5)
+        resp = _HTTP.get(url, headers=validators, timeout=_HTTP_TIMEOUT)
+        if resp.status_code == 304:
+            return _NOT_MODIFIED, validators
         if resp.ok:
-            data = resp.json()
-            addr = data.get('address', {})
-            # Prefer street/road, then neighbourhood, suburb, city, state, country
-            fields = [
-                'road', 'pedestrian', 'footway', 'cycleway', 'neighbourhood', 'suburb', 'village', 'town', 'city', 'state', 'country'
-            ]
-            parts = [addr.get(f) for f in fields if addr.get(f)]
-            if parts:
-                return ', '.join(parts)
-            # Fallback to display_name
-            if 'display_name' in data and data['display_name']:
-                return data['display_name']
-            if 'name' in data and data['name']:
-                return data['name']
+            new_validators = {}
+            if resp.headers.get("ETag"):
+                new_validators["If-None-Match"] = resp.headers["ETag"]
+            if resp.headers.get("Last-Modified"):
+                new_validators["If-Modified-Since"] = resp.headers["Last-Modified"]
+            return _json_loads(resp.content), new_validators or None
     except Exception:
         pass
-    return "Unknown Location"
+    return None, None
 
 
-def get_weather(latitude: float, longitude: float):
-    """Fetch current weather for the location using Open-Meteo (no API key required). Returns (icon_path, temp_str)."""
+def _fetch_address(latitude: float, longitude: float, validators: Optional[dict] = None):
+    """Query Nominatim for an address. Returns (address, validators); address is None if the lookup failed."""
+    url = f"https://nominatim.openstreetmap.org/reverse?format=jsonv2&lat={latitude}&lon={longitude}&zoom=16&addressdetails=1"
+    data, validators = _get_json(url, validators)
+    if data is None or data is _NOT_MODIFIED:
+        return data, validators
     try:
-        url = f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&current_weather=true"
-        resp = requests.get(url, timeout=5)
-        if resp.ok:
-            data = resp.json()
-            weather = data.get('current_weather', {})
-            temp = weather.get('temperature')
-            code = weather.get('weathercode')
-            icon_file = WEATHER_ICON_MAP.get(code)
-            icon_path = str(WEATHER_ICON_DIR / icon_file) if icon_file and (WEATHER_ICON_DIR / icon_file).exists() else None
-            temp_str = f"{temp:.1f}°C" if temp is not None else "N/A"
-            return icon_path, temp_str
+        addr = data.get('address', {})
+        # Prefer street/road, then neighbourhood, suburb, city, state, country
+        fields = [
+            'road', 'pedestrian', 'footway', 'cycleway', 'neighbourhood', 'suburb', 'village', 'town', 'city', 'state', 'country'
+        ]
+        parts = [addr.get(f) for f in fields if addr.get(f)]
+        if parts:
+            return ', '.join(parts), validators
+        # Fallback to display_name
+        if 'display_name' in data and data['display_name']:
+            return data['display_name'], validators
+        if 'name' in data and data['name']:
+            return data['name'], validators
     except Exception:
         pass
-    return None, "N/A"
+    return None, None
 
 
-def overlay_with_map_and_info(
-    img: Image.Image,
-    latitude: float,
-    longitude: float,
-    date: str,
-    time: str,
-    map_image_path: Optional[str] = None
-) -> Image.Image:
+def get_address(latitude: float, longitude: float) -> str:
+    """Reverse geocode lat/lon to a detailed address using Nominatim (cached for ADDRESS_TTL)."""
+    address = _cached_lookup("address", _ADDRESS_CACHE, _fetch_address, latitude, longitude)
+    return address if address is not None else "Unknown Location"
+
+
+@lru_cache(maxsize=None)
+def _icon_bundle() -> dict:
+    """Decode every bundled weather icon once, keyed by its path. Icons that are missing or unreadable are left out."""
+    bundle = {}
+    for icon_file in set(WEATHER_ICON_MAP.values()):
+        path = WEATHER_ICON_DIR / icon_file
+        try:
+            with Image.open(path) as icon:
+                bundle[str(path)] = icon.convert("RGBA")
+        except OSError:
+            log.warning("Weather icon %s could not be loaded", path)
+    return bundle
+
+
+@lru_cache(maxsize=None)
+def _weather_icon_path(code) -> Optional[str]:
+    """Path of the bundled icon for an Open-Meteo weather code, or None if the code has no (loadable) icon."""
+    icon_file = WEATHER_ICON_MAP.get(code)
+    if icon_file and str(WEATHER_ICON_DIR / icon_file) in _icon_bundle():
+        return str(WEATHER_ICON_DIR / icon_file)
+    return None
+
+
+def _fetch_weather(latitude: float, longitude: float, validators: Optional[dict] = None):
+    """Query Open-Meteo for current weather. Returns ((icon_path, temp_str), validators), or (None, None) if the lookup failed."""
+    url = f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&current_weather=true"
+    data, validators = _get_json(url, validators)
+    if data is None or data is _NOT_MODIFIED:
+        return data, validators
+    try:
+        weather = data.get('current_weather', {})
+        temp = weather.get('temperature')
+        code = weather.get('weathercode')
+        icon_path = _weather_icon_path(code)
+        temp_str = f"{temp:.1f}°C" if temp is not None else "N/A"
+        return (icon_path, temp_str), validators
+    except Exception:
+        pass
+    return None, None
+
+
+def get_weather(latitude: float, longitude: float):
+    """Fetch current weather for the location using Open-Meteo (no API key required). Returns (icon_path, temp_str)."""
+    weather = _cached_lookup("weather", _WEATHER_CACHE, _fetch_weather, latitude, longitude, WEATHER_MAX_STALE)
+    if weather is None:
+        return None, "N/A"
+    # The disk cache stores JSON, which turns the tuple into a list
+    return tuple(weather)
+
+
+# Font names that failed to load; later sizes skip straight to the fallback instead of searching again
+_MISSING_FONTS = set()
+
+
+@lru_cache(maxsize=64)
+def _font(name: str, size: int) -> ImageFont.FreeTypeFont:
+    """Load a TrueType font once per (name, size), falling back to Pillow's default font."""
+    if name not in _MISSING_FONTS:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            _MISSING_FONTS.add(name)
+    return ImageFont.load_default()
+
+
+def _line_height(font: ImageFont.FreeTypeFont) -> int:
+    """Height of a capital "A" in font, used as the line advance. Only measured while building a (cached) LayoutPlan."""
+    bbox = font.getbbox("A")
+    return bbox[3] - bbox[1]
+
+
+def _wrap_greedy(widths, space_w: float, max_width: float) -> list:
     """
-    Overlay a single-row geotag card at the bottom of the image.
-    Layout: 3 columns (map | address/date/time/coords | weather)
-    Center column: address (word-wrapped), date+time below, lat+lon below.
-    Weather column: icon (smaller), temp text below icon, both centered.
-    Dynamically adapts to image aspect ratio for best fit.
+    Greedy line breaking on precomputed word widths. Returns the index of the first word of each line after the first.
+    Pure arithmetic on floats, so it stays independent of PIL and of how the widths were measured.
     """
-    print("[DEBUG] Starting overlay_with_map_and_info")
-    # --- Load map image (screenshot from frontend) ---
+    breaks = []
+    line_w = None
+    for i, word_w in enumerate(widths):
+        if line_w is not None and line_w + space_w + word_w > max_width:
+            breaks.append(i)
+            line_w = None
+        line_w = word_w if line_w is None else line_w + space_w + word_w
+    return breaks
+
+
+def _wrap_words(text: str, font, max_width: float) -> list:
+    """Greedily break text into lines no wider than max_width. A word wider than max_width gets a line of its own."""
+    words = text.split()
+    # Measure each word once, then break on the numbers alone
+    breaks = _wrap_greedy([font.getlength(word) for word in words], font.getlength(" "), max_width)
+    starts = [0] + breaks
+    ends = breaks + [len(words)]
+    return [' '.join(words[start:end]) for start, end in zip(starts, ends) if end > start]
+
+
+@lru_cache(maxsize=128)
+def _resized_weather_icon(path: str, size: int) -> Image.Image:
+    """Resize a weather icon once per (path, size). The result is shared: paste from it, don't draw on it."""
+    icon = _icon_bundle().get(path)
+    if icon is None:
+        # Not one of the bundled icons (e.g. a caller-supplied path): decode it here
+        with Image.open(path) as src:
+            icon = src.convert("RGBA")
+    return icon.resize((size, size), Image.Resampling.BICUBIC)
+
+
+def _weather_icon(path: str, size: int) -> Optional[Image.Image]:
+    """The weather icon at path resized to size x size, or None if there is no such file."""
+    # Checked outside the cache, so an icon that appears later isn't remembered as missing
+    if path not in _icon_bundle() and not Path(path).exists():
+        return None
+    return _resized_weather_icon(path, size)
+
+
+def _future_result(future, default, deadline: float):
+    """Wait until deadline (a time.monotonic() value) for a lookup submitted to _LOOKUPS; default if it fails or is late."""
     try:
-        if map_image_path:
-            print(f"[DEBUG] Loading map image from {map_image_path}")
-            map_img = Image.open(map_image_path).convert("RGBA")
-        else:
-            print("[DEBUG] No map image path provided, using blank map")
-            map_img = Image.new("RGBA", (320, 180), (220, 220, 220, 255))
-    except Exception as e:
-        print(f"[ERROR] Loading map image failed: {e}")
-        map_img = Image.new("RGBA", (320, 180), (220, 220, 220, 255))
-    print("[DEBUG] Map image loaded")
-    print("[DEBUG] Fetching address...")
-    address = get_address(latitude, longitude)
-    print(f"[DEBUG] Address: {address}")
-    print("[DEBUG] Fetching weather...")
-    weather_icon_path, temp_str = get_weather(latitude, longitude)
-    print(f"[DEBUG] Weather icon: {weather_icon_path}, Temp: {temp_str}")
-    width, height = img.size
-    print(f"[DEBUG] Image size: {width}x{height}")
+        return future.result(timeout=max(0.0, deadline - _time.monotonic()))
+    except Exception:
+        return default
+
+
+# Resampling filter for the map thumbnail, from the "resize_filter" setting (BILINEAR if unset or unknown)
+MAP_RESIZE_FILTER = getattr(Image.Resampling, str(get_settings().get("resize_filter") or "bilinear").upper(), Image.Resampling.BILINEAR)
+
+# Below this size the three columns no longer fit, so no overlay is drawn (only the EXIF tags are written)
+MIN_OVERLAY_WIDTH = 200
+MIN_OVERLAY_HEIGHT = 64
+
+
+def overlay_fits(width: int, height: int) -> bool:
+    """Whether a width x height image is large enough to get the overlay (and so needs the address/weather lookups)."""
+    return width >= MIN_OVERLAY_WIDTH and height >= MIN_OVERLAY_HEIGHT
+
 
-    # Overlay dimensions
+def image_fits_overlay(image_bytes: bytes) -> bool:
+    """overlay_fits for an encoded image; only the header is read, the pixels are not decoded."""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        return overlay_fits(*img.size)
+
+# How much larger than the thumbnail a screenshot stays after the integer reduce() pre-pass
+MAP_REDUCING_GAP = 2.0
+
+# Placeholder map used when the frontend sent no (readable) screenshot
+BLANK_MAP_SIZE = (320, 180)
+BLANK_MAP_COLOR = (220, 220, 220, 255)
+# Transparent margin around the map thumbnail; the bar shows through it
+MAP_BORDER = 2
+
+# The info bar is a constant (28,28,28) tint at alpha 210, blended straight into the photo's bottom strip
+BAR_COLOR = (28, 28, 28)
+BAR_ALPHA = 210
+
+
+def _fit_map_size(src_width: int, src_height: int, map_col_w: int, overlay_height: int) -> Tuple[int, int]:
+    """Scale (src_width, src_height) to fit the map column, keeping the aspect ratio."""
+    map_target_height = overlay_height - 10
+    map_target_width = int(src_width * (map_target_height / src_height))
+    if map_target_width > map_col_w - 8:
+        map_target_width = map_col_w - 8
+        map_target_height = int(src_height * (map_target_width / src_width))
+    return max(1, map_target_width), max(1, map_target_height)
+
+
+def _load_map_tile(map_image_path, map_col_w: int, overlay_height: int, high_quality: bool = False) -> Image.Image:
+    """
+    Build the map thumbnail for the left column, sized to leave room for MAP_BORDER on each side.
+    The thumbnail is RGB for opaque screenshots and RGBA otherwise.
+    Uses the frontend screenshot (a path or file object) if given; otherwise the blank placeholder is created directly at the
+    final size, so nothing has to be resized.
+    """
+    map_img = None
+    if map_image_path:
+        try:
+            log.debug("Loading map image")
+            map_img = Image.open(map_image_path)
+            # JPEG screenshots can be decoded straight at 1/2-1/8 scale; the thumbnail is far smaller anyway
+            map_img.draft("RGB", (map_col_w * 2, overlay_height * 2))
+            # Opaque RGB screenshots stay RGB through the resize (no full-size alpha band to expand and premultiply);
+            # anything else goes to RGBA so palette or grey transparency survives
+            if map_img.mode not in ("RGB", "RGBA"):
+                map_img = map_img.convert("RGBA")
+            # Decode now, so a truncated or corrupt upload falls back to the placeholder instead of failing in resize()
+            map_img.load()
+        except Exception:
+            log.exception("Loading map image failed")
+            map_img = None
+    if map_img is None:
+        log.debug("No map image, using blank map")
+        map_resized = Image.new("RGBA", _fit_map_size(*BLANK_MAP_SIZE, map_col_w, overlay_height), BLANK_MAP_COLOR)
+    else:
+        target = _fit_map_size(map_img.width, map_img.height, map_col_w, overlay_height)
+        # Box-average large screenshots down by a whole factor first, staying at least MAP_REDUCING_GAP times the
+        # target, so the resampling filter only runs over a small image (what Image.thumbnail does internally)
+        factor = int(min(map_img.width / target[0], map_img.height / target[1]) / MAP_REDUCING_GAP)
+        if factor > 1:
+            map_img = map_img.reduce(factor)
+        map_resized = map_img.resize(target, resample=Image.Resampling.LANCZOS if high_quality else MAP_RESIZE_FILTER)
+    return map_resized
+
+
+class LayoutPlan(NamedTuple):
+    """Everything about the info bar that depends only on the image size: column geometry, fonts and spacing."""
+    overlay_height: int
+    col_pad: int
+    map_col_w: int
+    center_col_w: int
+    weather_col_w: int
+    center_x: int
+    font_addr: ImageFont.FreeTypeFont
+    font_meta: ImageFont.FreeTypeFont
+    addr_line_height: int
+    addr_line_spacing: int
+    meta_height: int
+    meta_spacing: int
+    wx_icon_size: int
+    wx_x: int
+    wx_y: int
+    font_temp: ImageFont.FreeTypeFont
+
+
+@lru_cache(maxsize=64)
+def _layout_plan(width: int, height: int) -> LayoutPlan:
+    """Work out the bar layout for a width x height image; photos from one camera share a plan."""
     overlay_height = int(height * 0.22)
-    overlay = Image.new("RGBA", (width, overlay_height), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(overlay)
-    draw.rectangle([(0, 0), (width, overlay_height)], fill=(28, 28, 28, 210))
-    print("[DEBUG] Overlay created (rectangle)")
+    assert overlay_height > 0, "image is below MIN_OVERLAY_HEIGHT"
 
     # --- Dynamic column widths based on aspect ratio ---
     aspect = width / height
@@ -123,163 +500,190 @@ def overlay_with_map_and_info(
         map_col_w = int(overlay_height * 1.1)
         weather_col_w = int(overlay_height * 0.7)
         center_col_w = width - map_col_w - weather_col_w - 2 * col_pad * 2
-    print(f"[DEBUG] Column widths: map={map_col_w}, center={center_col_w}, weather={weather_col_w}")
+
+    # --- Center column fonts; reduce font size for very tall images ---
+    if aspect < 0.7:
+        font_size_addr = max(12, overlay_height // 8)
+        font_size_meta = max(9, overlay_height // 14)
+        addr_line_spacing = 10  # increased spacing
+        meta_spacing = 18       # increased spacing
+    else:
+        font_size_addr = max(16, overlay_height // 6)
+        font_size_meta = max(13, overlay_height // 9)
+        addr_line_spacing = 14  # increased spacing
+        meta_spacing = 24       # increased spacing
+    font_addr = _font("arialbd.ttf", font_size_addr)
+    font_meta = _font("arial.ttf", font_size_meta)
+
+    # --- Weather column: icon centered, temperature below it ---
+    wx_icon_size = int(weather_col_w * 0.35)
+    wx_x = width - weather_col_w + (weather_col_w - wx_icon_size) // 2 - col_pad
+    wx_y = (overlay_height - wx_icon_size - 12) // 2
+    font_temp = _font("arial.ttf", max(10, wx_icon_size // 3))
+
+    return LayoutPlan(
+        overlay_height, col_pad, map_col_w, center_col_w, weather_col_w, col_pad + map_col_w + col_pad,
+        font_addr, font_meta, _line_height(font_addr), addr_line_spacing, _line_height(font_meta), meta_spacing,
+        wx_icon_size, wx_x, wx_y, font_temp,
+    )
+
+
+def overlay_with_map_and_info(
+    img: Image.Image,
+    latitude: float,
+    longitude: float,
+    date: str,
+    time: str,
+    map_image_path=None,
+    precomputed: Optional[Tuple[str, Optional[str], str]] = None,
+    high_quality: bool = False
+) -> Image.Image:
+    """
+    Overlay a single-row geotag card at the bottom of the image.
+    Layout: 3 columns (map | address/date/time/coords | weather)
+    Center column: address (word-wrapped), date+time below, lat+lon below.
+    Weather column: icon (smaller), temp text below icon, both centered.
+    Dynamically adapts to image aspect ratio for best fit.
+    map_image_path may be a file path or an open file object (e.g. BytesIO).
+    If precomputed=(address, weather_icon_path, temp_str) is given, the lookups are skipped.
+    The bar is blended and drawn straight into the image, with no separate overlay buffer; an RGB img is changed in
+    place, other modes are converted to a new RGB image first.
+    The map thumbnail is resized with MAP_RESIZE_FILTER, or LANCZOS when high_quality is set.
+    Images smaller than MIN_OVERLAY_WIDTH x MIN_OVERLAY_HEIGHT are returned unchanged, without any lookups.
+    """
+    log.debug("Starting overlay_with_map_and_info")
+    if not overlay_fits(img.width, img.height):
+        log.debug("Image too small for the overlay (%dx%d), skipping it", img.width, img.height)
+        return img
+    if precomputed is not None:
+        address, weather_icon_path, temp_str = precomputed
+        address_future = weather_future = None
+    else:
+        # The two lookups are independent and network-bound: run them on worker threads
+        # while the layout and map are prepared, and collect them just before they're drawn
+        log.debug("Fetching address and weather...")
+        address_future = _LOOKUPS.submit(get_address, latitude, longitude)
+        weather_future = _LOOKUPS.submit(get_weather, latitude, longitude)
+        # Both lookups share one deadline, so two stalled lookups still cost at most LOOKUP_TIMEOUT
+        lookup_deadline = _time.monotonic() + LOOKUP_TIMEOUT
+    width, height = img.size
+    log.debug("Image size: %dx%d", width, height)
+
+    # Layout depends only on the image size, so it is computed once per resolution
+    plan = _layout_plan(width, height)
+    log.debug("Column widths: map=%d, center=%d, weather=%d", plan.map_col_w, plan.center_col_w, plan.weather_col_w)
+
+    # Draw on the photo itself: the "RGBA" draw mode alpha-blends the bar and the translucent text in place,
+    # so no strip-sized buffer is allocated per call. Everything below is positioned relative to bar_top.
+    overlay_height = plan.overlay_height
+    out_img = img if img.mode == "RGB" else img.convert("RGB")
+    bar_top = height - overlay_height
+    draw = ImageDraw.Draw(out_img, "RGBA")
+    draw.rectangle((0, bar_top, width - 1, height - 1), fill=BAR_COLOR + (BAR_ALPHA,))
+    log.debug("Overlay created (tinted strip)")
 
     # --- Map (left column, flush left) ---
     try:
-        map_target_height = overlay_height - 10
-        map_target_width = int(map_img.width * (map_target_height / map_img.height))
-        if map_target_width > map_col_w - 8:
-            map_target_width = map_col_w - 8
-            map_target_height = int(map_img.height * (map_target_width / map_img.width))
-        map_resized = map_img.resize((max(1,map_target_width), max(1,map_target_height)), resample=Image.Resampling.LANCZOS)
-        border = 2
-        map_box = Image.new("RGBA", (map_target_width + 2*border, map_target_height + 2*border), (0,0,0,0))
-        map_box.paste(map_resized, (border, border), map_resized)
-        map_y = (overlay_height - map_box.height) // 2
-        overlay.paste(map_box, (col_pad, map_y), map_box)
-        print("[DEBUG] Map column drawn (left)")
-    except Exception as e:
-        print(f"[ERROR] Drawing map column failed: {e}")
+        map_tile = _load_map_tile(map_image_path, plan.map_col_w, overlay_height, high_quality)
+        # Center the bordered tile; the border is transparent, so only the thumbnail itself is pasted
+        map_y = (overlay_height - map_tile.height - 2 * MAP_BORDER) // 2
+        map_mask = map_tile if map_tile.mode == "RGBA" else None
+        out_img.paste(map_tile, (plan.col_pad + MAP_BORDER, bar_top + map_y + MAP_BORDER), map_mask)
+        log.debug("Map column drawn (left)")
+    except Exception:
+        log.exception("Drawing map column failed")
+
+    if address_future is not None:
+        address = _future_result(address_future, "Unknown Location", lookup_deadline)
+        weather_icon_path, temp_str = _future_result(weather_future, (None, "N/A"), lookup_deadline)
+    log.debug("Address: %s", address)
+    log.debug("Weather icon: %s, Temp: %s", weather_icon_path, temp_str)
 
     # --- Center column: address (word-wrapped), date+time, lat+lon ---
     try:
-        print("[DEBUG] Center column: loading fonts...")
-        # Reduce font size for very tall images
-        if aspect < 0.7:
-            font_size_addr = max(12, overlay_height // 8)
-            font_size_meta = max(9, overlay_height // 14)
-            addr_line_spacing = 10  # increased spacing
-            meta_spacing = 18       # increased spacing
-        else:
-            font_size_addr = max(16, overlay_height // 6)
-            font_size_meta = max(13, overlay_height // 9)
-            addr_line_spacing = 14  # increased spacing
-            meta_spacing = 24       # increased spacing
-        try:
-            font_addr = ImageFont.truetype("arialbd.ttf", font_size_addr)
-        except Exception:
-            font_addr = ImageFont.load_default()
-        try:
-            font_meta = ImageFont.truetype("arial.ttf", font_size_meta)
-        except Exception:
-            font_meta = ImageFont.load_default()
-        print("[DEBUG] Center column: fonts loaded")
-
-        # Address (word-wrapped, with safety)
-        center_x = col_pad + map_col_w + col_pad
-        max_addr_width = center_col_w
-        addr_lines = []
-        words = address.split()
-        word_wrap_safety = 0
-        print(f"[DEBUG] Center column: address split into {len(words)} words")
-        while words and word_wrap_safety < 10:
-            line = ''
-            inner_wrap_safety = 0
-            while words and inner_wrap_safety < 50:
-                test_line = line + ('' if not line else ' ') + words[0]
-                bbox = draw.textbbox((0, 0), test_line, font=font_addr)
-                w = bbox[2] - bbox[0]
-                if w <= max_addr_width:
-                    line = test_line
-                    words.pop(0)
-                else:
-                    break
-                inner_wrap_safety += 1
-            if line:
-                addr_lines.append(line)
-            word_wrap_safety += 1
-        if not addr_lines:
-            addr_lines = [address]
-        print(f"[DEBUG] Center column: address wrapped into {len(addr_lines)} lines")
-        addr_line_height = font_addr.getbbox("A")[3] - font_addr.getbbox("A")[1]
-        addr_block_height = len(addr_lines) * (addr_line_height + addr_line_spacing)
+        # Address (word-wrapped)
+        addr_lines = _wrap_words(address, plan.font_addr, plan.center_col_w) or [address]
+        log.debug("Center column: address wrapped into %d lines", len(addr_lines))
+        addr_block_height = len(addr_lines) * (plan.addr_line_height + plan.addr_line_spacing)
 
         # Date/time and lat/lon
-        meta_height = font_meta.getbbox("A")[3] - font_meta.getbbox("A")[1]
         date_time_str = f"{date} {time}"
         latlon_str = f"{latitude:.5f}, {longitude:.5f}"
-        meta_block_height = meta_height * 2 + meta_spacing
+        meta_block_height = plan.meta_height * 2 + plan.meta_spacing
 
         # Vertical stacking for center column (address, date/time, lat/lon)
-        total_center_height = addr_block_height + meta_block_height + meta_spacing * 2  # extra space between blocks
-        center_y = (overlay_height - total_center_height) // 2
-        y_cursor = center_y
+        total_center_height = addr_block_height + meta_block_height + plan.meta_spacing * 2  # extra space between blocks
+        if total_center_height > overlay_height:
+            # Too tall for the bar: draw on a crop of it instead, so the text is clipped at the bar's top edge
+            text_box = (plan.center_x, bar_top, width, height)
+            text_img = out_img.crop(text_box)
+            text_draw, text_x, y_cursor = ImageDraw.Draw(text_img, "RGBA"), 0, 0
+        else:
+            text_img = None
+            text_draw, text_x, y_cursor = draw, plan.center_x, bar_top
+        y_cursor += (overlay_height - total_center_height) // 2
         # Draw address lines
         for line in addr_lines:
-            draw.text((center_x, y_cursor), line, font=font_addr, fill=(255,255,255,255))
-            y_cursor += addr_line_height + addr_line_spacing
-        y_cursor += meta_spacing  # extra space before date/time
+            text_draw.text((text_x, y_cursor), line, font=plan.font_addr, fill=(255,255,255,255))
+            y_cursor += plan.addr_line_height + plan.addr_line_spacing
+        y_cursor += plan.meta_spacing  # extra space before date/time
         # Draw date/time
-        draw.text((center_x, y_cursor), date_time_str, font=font_meta, fill=(220,220,220,230))
-        y_cursor += meta_height + meta_spacing
+        text_draw.text((text_x, y_cursor), date_time_str, font=plan.font_meta, fill=(220,220,220,230))
+        y_cursor += plan.meta_height + plan.meta_spacing
         # Draw lat/lon
-        draw.text((center_x, y_cursor), latlon_str, font=font_meta, fill=(180,180,180,210))
-        print("[DEBUG] Center column drawn")
-    except Exception as e:
-        print(f"[ERROR] Drawing center column failed: {e}")
+        text_draw.text((text_x, y_cursor), latlon_str, font=plan.font_meta, fill=(180,180,180,210))
+        if text_img is not None:
+            out_img.paste(text_img, text_box)
+        log.debug("Center column drawn")
+    except Exception:
+        log.exception("Drawing center column failed")
 
     # --- Weather (right column) ---
-    print("[DEBUG] Entering weather column block...")
+    log.debug("Entering weather column block...")
     try:
-        wx_icon_size = int(weather_col_w * 0.35)
-        wx_x = width - weather_col_w + (weather_col_w - wx_icon_size) // 2 - col_pad
-        wx_y = (overlay_height - wx_icon_size - 12) // 2
-        if weather_icon_path and Path(weather_icon_path).exists():
-            wx_icon = Image.open(weather_icon_path).convert("RGBA").resize((wx_icon_size, wx_icon_size))
-            overlay.paste(wx_icon, (wx_x, wx_y), wx_icon)
-        font_size_temp = max(10, wx_icon_size // 3)
-        try:
-            font_temp = ImageFont.truetype("arial.ttf", font_size_temp)
-        except Exception:
-            font_temp = ImageFont.load_default()
+        wx_icon = _weather_icon(weather_icon_path, plan.wx_icon_size) if weather_icon_path else None
+        if wx_icon is not None:
+            out_img.paste(wx_icon, (plan.wx_x, bar_top + plan.wx_y), wx_icon)
         temp_color = (255, 255, 255, 230)
-        temp_bbox = font_temp.getbbox(temp_str)
+        temp_bbox = plan.font_temp.getbbox(temp_str)
         temp_width = temp_bbox[2] - temp_bbox[0]
-        temp_x = wx_x + (wx_icon_size - temp_width) // 2
-        temp_y = wx_y + wx_icon_size + 2
-        draw.text((temp_x, temp_y), temp_str, font=font_temp, fill=temp_color)
-        print("[DEBUG] Weather column drawn")
-    except Exception as e:
-        print(f"[ERROR] Drawing weather column failed: {e}")
-
-    # --- Composite overlay onto image ---
-    try:
-        out_img = img.convert("RGBA")
-        out_img.alpha_composite(overlay, (0, height - overlay_height))
-        print("[DEBUG] Overlay composited onto image")
-        return out_img.convert("RGB")
-    except Exception as e:
-        print(f"[ERROR] Compositing overlay failed: {e}")
-        return img
+        temp_x = plan.wx_x + (plan.wx_icon_size - temp_width) // 2
+        temp_y = bar_top + plan.wx_y + plan.wx_icon_size + 2
+        draw.text((temp_x, temp_y), temp_str, font=plan.font_temp, fill=temp_color)
+        log.debug("Weather column drawn")
+    except Exception:
+        log.exception("Drawing weather column failed")
+
+    return out_img
 
 
 # Removed duplicate embed_metadata function to resolve name conflict.
 
-def embed_metadata(input_path: str, output_path: str, latitude: float, longitude: float, date: str, time: str, map_image_path: Optional[str] = None) -> None:
-    """
-    Embed EXIF metadata (GPS, date/time) into an image and save to output_path.
-    Also overlays map and info at the bottom. If map_image_path is provided, use it as the map overlay.
-    """
-    img = Image.open(input_path)
-    # Overlay map and info
-    img = overlay_with_map_and_info(img, latitude, longitude, date, time, map_image_path)
-    # Try to load EXIF, or create a new one if not present
-    try:
-        exif_bytes = img.info.get('exif')
-        exif_dict = piexif.load(exif_bytes) if exif_bytes else {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}, "thumbnail": None}
-    except Exception:
+def _to_deg_rational(value: float):
+    """Convert a decimal coordinate to EXIF (degrees, minutes, seconds) rationals; seconds in 1/100 units."""
+    # Round once to whole hundredths of an arc-second, then split with integer arithmetic (no float truncation)
+    total = round(abs(value) * 360000)
+    deg, rem = divmod(total, 360000)
+    min_, sec100 = divmod(rem, 6000)
+    return ((deg, 1), (min_, 1), (sec100, 100))
+
+
+def _geotag_exif(exif_bytes: Optional[bytes], latitude: float, longitude: float, date: str, time: str) -> dict:
+    """Return an EXIF dict (loaded from exif_bytes, or empty) with GPS and date/time tags set."""
+    # Only parse when the image actually carries EXIF; most uploads (screenshots, PNGs, edited files) have none
+    exif_dict = None
+    if exif_bytes:
+        try:
+            exif_dict = piexif.load(exif_bytes)
+        except Exception:
+            log.warning("Ignoring unreadable EXIF block in the input image")
+    if exif_dict is None:
         exif_dict = {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}, "thumbnail": None}
     # GPS
-    def to_deg(value):
-        deg = int(abs(value))
-        min_ = int((abs(value) - deg) * 60)
-        sec = float((abs(value) - deg - min_ / 60) * 3600)
-        return ((deg, 1), (min_, 1), (int(sec * 100), 100))
     exif_dict['GPS'][piexif.GPSIFD.GPSLatitudeRef] = b'N' if latitude >= 0 else b'S'
-    exif_dict['GPS'][piexif.GPSIFD.GPSLatitude] = to_deg(latitude)
+    exif_dict['GPS'][piexif.GPSIFD.GPSLatitude] = _to_deg_rational(latitude)
     exif_dict['GPS'][piexif.GPSIFD.GPSLongitudeRef] = b'E' if longitude >= 0 else b'W'
-    exif_dict['GPS'][piexif.GPSIFD.GPSLongitude] = to_deg(longitude)
+    exif_dict['GPS'][piexif.GPSIFD.GPSLongitude] = _to_deg_rational(longitude)
     dt_fmt = "%Y-%m-%d %H:%M"
     try:
         dt_str = f"{date} {time}"
@@ -290,26 +694,104 @@ def embed_metadata(input_path: str, output_path: str, latitude: float, longitude
         exif_dict['Exif'][piexif.ExifIFD.DateTimeDigitized] = dt_bytes
     except Exception:
         pass  # If date/time invalid, skip
-    exif_bytes = piexif.dump(exif_dict)
-    img.save(output_path, exif=exif_bytes)
+    return exif_dict
+
+
+def _draft_to_max_side(img: Image.Image, max_side: Optional[int]) -> None:
+    """Let the JPEG decoder scale down (1/2, 1/4, 1/8) while decoding when img is larger than max_side."""
+    width, height = img.size
+    longest = max(width, height)
+    if max_side and longest > max_side:
+        scale = max_side / longest
+        img.draft("RGB", (max(1, int(width * scale)), max(1, int(height * scale))))
+
+
+# Encoder options per output format; formats not listed use Pillow's defaults.
+# JPEG: single-pass encode with 4:2:0 chroma, no Huffman optimisation pass, baseline (non-progressive)
+SAVE_OPTIONS = {
+    "JPEG": {"quality": 85, "subsampling": "4:2:0", "optimize": False, "progressive": False},
+}
+# Image modes the JPEG encoder accepts as they are; anything else is converted to RGB first
+JPEG_MODES = {"1", "L", "RGB", "RGBX", "CMYK", "YCbCr"}
+
+
+def output_format_for(filename: str) -> Optional[str]:
+    """The Pillow format filename's extension asks for (as Image.save would pick it), or None if Pillow can't write it."""
+    output_format = Image.registered_extensions().get(Path(filename).suffix.lower())
+    return output_format if output_format in Image.SAVE else None
+
+
+def _embed(input_bytes: bytes, latitude: float, longitude: float, date: str, time: str, map_image=None, precomputed: Optional[Tuple[str, Optional[str], str]] = None, overlay: bool = True, max_side: Optional[int] = None, high_quality: bool = False, output_format: Optional[str] = None) -> Tuple[bytes, str]:
+    """
+    Shared implementation of embed_metadata/embed_metadata_bytes. map_image is a path or file object.
+    Returns (data, format written); output_format defaults to the input's format.
+    """
+    img = Image.open(io.BytesIO(input_bytes))
+    # MPO is how Pillow labels many camera JPEGs; write them back as plain JPEG
+    src_format = "JPEG" if img.format == "MPO" else img.format
+    output_format = output_format or src_format
+    # The EXIF tags don't depend on the pixels, so build them before touching the image data
+    exif_dict = _geotag_exif(img.info.get('exif'), latitude, longitude, date, time)
+    width, height = img.size
+    # Too small for the card: treat it like overlay=False, so a JPEG can take the splice path below
+    overlay = overlay and overlay_fits(img.width, img.height)
+    if not overlay and src_format == "JPEG" and output_format == "JPEG":
+        # Splice the new EXIF segment into the original bytes instead of decoding and re-encoding
+        out = io.BytesIO()
+        piexif.insert(piexif.dump(exif_dict), input_bytes, out)
+        return out.getvalue(), output_format
+    if overlay:
+        _draft_to_max_side(img, max_side if max_side is not None else get_settings().get("max_side"))
+        # A draft-decoded photo comes out smaller than the original: keep the EXIF pixel dimensions in step
+        if img.size != (width, height) and piexif.ExifIFD.PixelXDimension in exif_dict["Exif"]:
+            exif_dict["Exif"][piexif.ExifIFD.PixelXDimension], exif_dict["Exif"][piexif.ExifIFD.PixelYDimension] = img.size
+    # Serialize EXIF on a worker thread while the overlay is drawn
+    exif_future = _WORKERS.submit(piexif.dump, exif_dict)
+    if overlay:
+        # Overlay map and info
+        img = overlay_with_map_and_info(img, latitude, longitude, date, time, map_image, precomputed, high_quality)
+    if output_format == "JPEG" and img.mode not in JPEG_MODES:
+        # Without the overlay nothing has converted the image yet; JPEG has no alpha or palette
+        img = img.convert("RGB")
+    out = io.BytesIO()
+    save_start = _time.perf_counter()
+    img.save(out, format=output_format, exif=exif_future.result(), **SAVE_OPTIONS.get(output_format, {}))
+    log.debug("Encoded %s in %.1f ms", output_format, (_time.perf_counter() - save_start) * 1000)
+    return out.getvalue(), output_format
+
+
+def embed_metadata_bytes(input_bytes: bytes, latitude: float, longitude: float, date: str, time: str, map_image: Optional[bytes] = None, precomputed: Optional[Tuple[str, Optional[str], str]] = None, overlay: bool = True, max_side: Optional[int] = None, high_quality: bool = False, output_format: Optional[str] = None) -> Tuple[bytes, str]:
+    """
+    In-memory version of embed_metadata: takes the encoded image (and optional map screenshot) as bytes
+    and returns (geotagged image bytes, Pillow format name). The image is written as output_format if given,
+    otherwise in the same format as the input. No temp files are involved.
+    """
+    map_file = io.BytesIO(map_image) if map_image else None
+    return _embed(input_bytes, latitude, longitude, date, time, map_file, precomputed, overlay, max_side, high_quality, output_format)
+
+
+def embed_metadata(input_path: str, output_path: str, latitude: float, longitude: float, date: str, time: str, map_image_path: Optional[str] = None, precomputed: Optional[Tuple[str, Optional[str], str]] = None, overlay: bool = True, max_side: Optional[int] = None, high_quality: bool = False) -> None:
+    """
+    Embed EXIF metadata (GPS, date/time) into an image and save to output_path.
+    Also overlays map and info at the bottom. If map_image_path is provided, use it as the map overlay.
+    precomputed is passed through to overlay_with_map_and_info to reuse already fetched address/weather.
+    With overlay=False a JPEG is not re-encoded: the EXIF segment is spliced into a copy of the original file.
+    max_side (default: the "max_side" setting, off unless set) lets large JPEGs be decoded, and written, at a reduced
+    scale before the overlay is drawn; the EXIF pixel dimensions are updated to match.
+    high_quality selects the slower LANCZOS filter for the map thumbnail.
+    """
+    with open(input_path, "rb") as f:
+        input_bytes = f.read()
+    # As with Image.save, the output format follows the output file's extension
+    output_format = output_format_for(output_path)
+    data, _ = _embed(input_bytes, latitude, longitude, date, time, map_image_path, precomputed, overlay, max_side, high_quality, output_format)
+    with open(output_path, "wb") as f:
+        f.write(data)
 
 
 def draw_wrapped_text(draw, text, font, x, y, max_width, fill, line_spacing=4):
-    """Draw text with word wrap to fit max_width using draw.textbbox for width measurement."""
-    lines = []
-    words = text.split()
-    while words:
-        line = ''
-        while words:
-            test_line = line + ('' if not line else ' ') + words[0]
-            bbox = draw.textbbox((0, 0), test_line, font=font)
-            w = bbox[2] - bbox[0]
-            if w <= max_width:
-                line = test_line
-                words.pop(0)
-            else:
-                break
-        lines.append(line)
+    """Draw text with word wrap to fit max_width using font.getlength for width measurement."""
+    lines = _wrap_words(text, font, max_width)
     for i, line in enumerate(lines):
         draw.text((x, y + i * (font.size + line_spacing)), line, font=font, fill=fill)
     return y + len(lines) * (font.size + line_spacing)
@@ -13,3 +13,264 @@ def test_embed_metadata(tmp_path):
     embed_metadata(str(img_path), str(out_path), 12.34, 56.78, "2024-01-01", "12:34")
     assert os.path.exists(out_path)
     # Optionally, check EXIF (not required for minimal test)
+
+def test_get_address_is_cached(monkeypatch, tmp_path):
+    from core import utils
+    utils._ADDRESS_CACHE.clear()
+    monkeypatch.setattr(utils, "_DISK_CACHE", utils._DiskCache(tmp_path / "cache.sqlite3"))
+    calls = []
+    def fake_fetch(lat, lon, validators=None):
+        calls.append((lat, lon))
+        return "Somewhere", None
+    monkeypatch.setattr(utils, "_fetch_address", fake_fetch)
+    assert utils.get_address(12.340001, 56.780001) == "Somewhere"
+    # Nearby coordinates round to the same key and are served from the cache
+    assert utils.get_address(12.340002, 56.780002) == "Somewhere"
+    assert len(calls) == 1
+    utils._ADDRESS_CACHE.clear()
+
+def test_embed_metadata_without_overlay_keeps_pixels(tmp_path):
+    from PIL import Image
+    import piexif
+    img_path = tmp_path / "test.jpg"
+    Image.new('RGB', (64, 48), color='blue').save(img_path)
+    out_path = tmp_path / "out.jpg"
+    embed_metadata(str(img_path), str(out_path), -12.5, 56.78, "2024-01-01", "12:34", overlay=False)
+    gps = piexif.load(str(out_path))["GPS"]
+    assert gps[piexif.GPSIFD.GPSLatitudeRef] == b'S'
+    assert gps[piexif.GPSIFD.GPSLatitude][0] == (12, 1)
+    # The JPEG data itself is copied, not re-encoded
+    assert list(Image.open(out_path).getdata()) == list(Image.open(img_path).getdata())
+
+def test_to_deg_rational_rounds_seconds():
+    from core.utils import _to_deg_rational
+    # 12.34 degrees is exactly 12 deg 20 min 24 sec; float truncation used to give 23.99
+    assert _to_deg_rational(12.34) == ((12, 1), (20, 1), (2400, 100))
+    assert _to_deg_rational(-12.5) == ((12, 1), (30, 1), (0, 100))
+    # Rounding carries into minutes and degrees
+    assert _to_deg_rational(179.99999999) == ((180, 1), (0, 1), (0, 100))
+
+def test_wrap_words_fits_width():
+    from core.utils import _font, _wrap_words
+    font = _font("arial.ttf", 16)
+    text = "Some Really Long Road Name, Neighbourhood, Bigcity, State, Country"
+    lines = _wrap_words(text, font, 150)
+    assert ' '.join(lines) == text
+    assert all(font.getlength(line) <= 150 or ' ' not in line for line in lines)
+    # A word wider than the limit still makes progress
+    assert _wrap_words("Supercalifragilistic", font, 10) == ["Supercalifragilistic"]
+
+def test_wrap_greedy_break_indices():
+    from core.utils import _wrap_greedy
+    assert _wrap_greedy([40, 40, 40, 40], 10, 100) == [2]
+    assert _wrap_greedy([120, 10], 10, 100) == [1]
+    assert _wrap_greedy([], 10, 100) == []
+
+def test_embed_metadata_bytes_keeps_format():
+    import io
+    from PIL import Image
+    import piexif
+    from core.utils import embed_metadata_bytes
+    buf = io.BytesIO()
+    Image.new('RGB', (400, 300), color='green').save(buf, format="PNG")
+    out, out_format = embed_metadata_bytes(buf.getvalue(), 12.34, 56.78, "2024-01-01", "12:34", precomputed=("Somewhere", None, "N/A"))
+    result = Image.open(io.BytesIO(out))
+    assert result.format == out_format == "PNG"
+    assert result.size == (400, 300)
+    assert piexif.load(result.info["exif"])["GPS"][piexif.GPSIFD.GPSLatitudeRef] == b'N'
+
+def test_download_name_matches_written_format():
+    from core.runner import _download_name
+    assert _download_name("photo.jpg", "JPEG") == "photo.jpg"
+    assert _download_name("photo.jpg", "PNG") == "photo.png"
+    assert _download_name("photo", "PNG") == "photo.png"
+
+
+def test_lookups_persist_on_disk(monkeypatch, tmp_path):
+    from core import utils
+    utils._WEATHER_CACHE.clear()
+    monkeypatch.setattr(utils, "_DISK_CACHE", utils._DiskCache(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(utils, "_fetch_weather", lambda lat, lon, validators=None: ((None, "21.0°C"), None))
+    assert utils.get_weather(1.0, 2.0) == (None, "21.0°C")
+    # A fresh process (empty memory cache) is served from SQLite without fetching
+    utils._WEATHER_CACHE.clear()
+    monkeypatch.setattr(utils, "_fetch_weather", lambda lat, lon, validators=None: (None, None))
+    assert utils.get_weather(1.0, 2.0) == (None, "21.0°C")
+    utils._WEATHER_CACHE.clear()
+
+
+def test_unusable_disk_cache_is_a_miss(monkeypatch, tmp_path):
+    from core import utils
+    utils._ADDRESS_CACHE.clear()
+    # The cache's parent "directory" is a regular file, so it can never be created
+    (tmp_path / "not_a_dir").write_text("")
+    monkeypatch.setattr(utils, "_DISK_CACHE", utils._DiskCache(tmp_path / "not_a_dir" / "cache.sqlite3"))
+    monkeypatch.setattr(utils, "_fetch_address", lambda lat, lon, validators=None: ("Somewhere", None))
+    assert utils.get_address(1.0, 2.0) == "Somewhere"
+    # A row that no longer decodes is a miss too
+    disk = utils._DiskCache(tmp_path / "cache.sqlite3")
+    disk.set("address:1.0,2.0", "Old Road")
+    disk._connect().execute("UPDATE geocache SET value = 'not json'")
+    assert disk.get("address:1.0,2.0") is None
+    utils._ADDRESS_CACHE.clear()
+
+
+def test_expired_lookup_is_revalidated(monkeypatch, tmp_path):
+    from core import utils
+    utils._ADDRESS_CACHE.clear()
+    disk = utils._DiskCache(tmp_path / "cache.sqlite3")
+    monkeypatch.setattr(utils, "_DISK_CACHE", disk)
+    disk.set("address:1.0,2.0", "Old Road", {"If-None-Match": '"v1"'})
+    monkeypatch.setattr(utils._ADDRESS_CACHE, "ttl", 0)
+    seen = []
+    def fake_fetch(lat, lon, validators=None):
+        seen.append(validators)
+        return utils._NOT_MODIFIED, validators
+    monkeypatch.setattr(utils, "_fetch_address", fake_fetch)
+    assert utils.get_address(1.0, 2.0) == "Old Road"
+    assert seen == [{"If-None-Match": '"v1"'}]
+    utils._ADDRESS_CACHE.clear()
+
+
+def test_old_weather_is_not_served_when_refresh_fails(monkeypatch, tmp_path):
+    import time
+    from core import utils
+    utils._WEATHER_CACHE.clear()
+    disk = utils._DiskCache(tmp_path / "cache.sqlite3")
+    monkeypatch.setattr(utils, "_DISK_CACHE", disk)
+    monkeypatch.setattr(utils, "_fetch_weather", lambda lat, lon, validators=None: (None, None))
+    disk.set("weather:1.0,2.0", [None, "35.0°C"])
+    disk._connect().execute("UPDATE geocache SET ts = ?", (time.time() - utils.WEATHER_TTL - 60,))
+    # Recently expired: still better than nothing
+    assert utils.get_weather(1.0, 2.0) == (None, "35.0°C")
+    utils._WEATHER_CACHE.clear()
+    disk._connect().execute("UPDATE geocache SET ts = ?", (time.time() - 90 * 24 * 60 * 60,))
+    assert utils.get_weather(1.0, 2.0) == (None, "N/A")
+    utils._WEATHER_CACHE.clear()
+
+@pytest.mark.parametrize("mode", ["RGBA", "P", "LA"])
+@pytest.mark.parametrize("size, overlay", [((10, 10), True), ((300, 200), False)])
+def test_jpeg_output_from_non_jpeg_modes(tmp_path, mode, size, overlay):
+    from PIL import Image
+    import piexif
+    img_path = tmp_path / "in.png"
+    Image.new(mode, size).save(img_path)
+    out_path = tmp_path / "out.jpg"
+    embed_metadata(str(img_path), str(out_path), 12.34, 56.78, "2024-01-01", "12:34", overlay=overlay)
+    out = Image.open(out_path)
+    assert out.format == "JPEG" and out.mode == "RGB"
+    assert piexif.load(str(out_path))["GPS"][piexif.GPSIFD.GPSLatitudeRef] == b'N'
+
+def test_tiny_image_skips_overlay_and_lookups(monkeypatch):
+    from PIL import Image
+    from core import utils
+    def fail(*args):
+        raise AssertionError("lookup should not run for a tiny image")
+    monkeypatch.setattr(utils, "get_address", fail)
+    monkeypatch.setattr(utils, "get_weather", fail)
+    img = Image.new('RGB', (10, 10), color='red')
+    out = utils.overlay_with_map_and_info(img, 12.34, 56.78, "2024-01-01", "12:34")
+    assert out is img and out.getpixel((5, 9)) == (255, 0, 0)
+    # The endpoint uses the header-only check to skip its own lookups
+    import io
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    assert not utils.image_fits_overlay(buf.getvalue())
+
+def test_truncated_map_falls_back_to_placeholder(tmp_path):
+    from PIL import Image
+    from core import utils
+    map_path = tmp_path / "map.png"
+    Image.effect_noise((640, 360), 60).convert("RGB").save(map_path)
+    data = map_path.read_bytes()
+    map_path.write_bytes(data[:len(data) // 2])
+    tile = utils._load_map_tile(str(map_path), 300, 220)
+    assert tile.getcolors() == [(tile.width * tile.height, utils.BLANK_MAP_COLOR)]
+
+def test_stalled_lookups_share_one_deadline(monkeypatch):
+    import threading
+    import time
+    from PIL import Image
+    from core import utils
+    release = threading.Event()
+    def stall(*args):
+        release.wait(5)
+        return "late"
+    monkeypatch.setattr(utils, "get_address", stall)
+    monkeypatch.setattr(utils, "get_weather", stall)
+    monkeypatch.setattr(utils, "LOOKUP_TIMEOUT", 0.3)
+    start = time.monotonic()
+    try:
+        utils.overlay_with_map_and_info(Image.new('RGB', (400, 300)), 12.34, 56.78, "2024-01-01", "12:34")
+    finally:
+        release.set()
+    assert time.monotonic() - start < 0.55
+
+def test_endpoint_context_falls_back_per_lookup(monkeypatch):
+    import asyncio
+    import threading
+    from core import runner
+    release = threading.Event()
+    def stalled_weather(*args):
+        release.wait(5)
+        return ("icon.png", "20.0°C")
+    monkeypatch.setattr(runner, "get_address", lambda lat, lon: "Somewhere")
+    monkeypatch.setattr(runner, "get_weather", stalled_weather)
+    try:
+        context = asyncio.run(runner._fetch_context(1.0, 2.0, timeout=0.2))
+    finally:
+        release.set()
+    assert context == ("Somewhere", None, "N/A")
+
+def test_endpoint_lookups_stay_off_the_default_thread_pool(monkeypatch):
+    import asyncio
+    import threading
+    from core import runner
+    threads = []
+    def record(*args):
+        threads.append(threading.current_thread().name)
+        return "Somewhere"
+    monkeypatch.setattr(runner, "get_address", record)
+    monkeypatch.setattr(runner, "get_weather", lambda lat, lon: ("icon.png", "20.0°C"))
+    asyncio.run(runner._fetch_context(1.0, 2.0))
+    assert threads and threads[0].startswith("geotag-lookup")
+
+def test_stale_lookup_is_remembered_after_failed_refresh(monkeypatch, tmp_path):
+    import time
+    from core import utils
+    utils._ADDRESS_CACHE.clear()
+    disk = utils._DiskCache(tmp_path / "cache.sqlite3")
+    monkeypatch.setattr(utils, "_DISK_CACHE", disk)
+    disk.set("address:1.0,2.0", "Old Road, Town")
+    disk._connect().execute("UPDATE geocache SET ts = ?", (time.time() - utils.ADDRESS_TTL - 60,))
+    calls = []
+    def failing_fetch(lat, lon, validators=None):
+        calls.append((lat, lon))
+        return None, None
+    monkeypatch.setattr(utils, "_fetch_address", failing_fetch)
+    assert utils.get_address(1.0, 2.0) == "Old Road, Town"
+    assert utils.get_address(1.0, 2.0) == "Old Road, Town"
+    assert len(calls) == 1
+    utils._ADDRESS_CACHE.clear()
+
+def test_max_side_is_opt_in_and_updates_exif_dimensions(tmp_path):
+    import piexif
+    from PIL import Image
+    img_path = tmp_path / "big.jpg"
+    exif = piexif.dump({"0th": {}, "Exif": {piexif.ExifIFD.PixelXDimension: 2000, piexif.ExifIFD.PixelYDimension: 1500}, "GPS": {}, "1st": {}, "thumbnail": None})
+    Image.new('RGB', (2000, 1500), color='red').save(img_path, exif=exif)
+    out_path = tmp_path / "out.jpg"
+    embed_metadata(str(img_path), str(out_path), 12.34, 56.78, "2024-01-01", "12:34", precomputed=("Somewhere", None, "N/A"))
+    assert Image.open(out_path).size == (2000, 1500)
+    embed_metadata(str(img_path), str(out_path), 12.34, 56.78, "2024-01-01", "12:34", precomputed=("Somewhere", None, "N/A"), max_side=800)
+    assert Image.open(out_path).size == (1000, 750)
+    dims = piexif.load(str(out_path))["Exif"]
+    assert (dims[piexif.ExifIFD.PixelXDimension], dims[piexif.ExifIFD.PixelYDimension]) == (1000, 750)
+
+def test_missing_weather_icon_is_not_remembered(tmp_path):
+    from PIL import Image
+    from core import utils
+    icon_path = str(tmp_path / "sun.png")
+    assert utils._weather_icon(icon_path, 24) is None
+    Image.new('RGBA', (64, 64), (255, 200, 0, 255)).save(icon_path)
+    assert utils._weather_icon(icon_path, 24).size == (24, 24)